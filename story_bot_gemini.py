@@ -4,15 +4,19 @@ import json
 import logging
 import os
 import random
+import re
+from contextlib import aclosing
 from io import BytesIO
 from pathlib import Path
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Awaitable, Callable, TypeVar
 
+import httpx
+import orjson
 from dotenv import load_dotenv
 import telegram
 from telegram import Bot, Poll, Message
 from google import genai
-from google.genai import types
+from google.genai import errors, types
 
 """
 Story Bot (Gemini, no images)
@@ -75,6 +79,11 @@ MAX_CONTEXT_CHARS = 15000
 MAX_POST_CHARS = 500
 STEP_INTERVAL_SECONDS = int(os.getenv("STEP_INTERVAL_SECONDS", "60"))
 
+# Повторы при временных сбоях Gemini
+GEMINI_RETRY_ATTEMPTS = 3
+GEMINI_RETRY_BASE_DELAY = 0.5
+GEMINI_RETRY_MAX_DELAY = 8.0
+
 # Опциональное генерация изображений
 ENABLE_IMAGE_GEN = os.getenv("ENABLE_IMAGE_GEN", "false").lower() in ("1", "true", "yes")
 GEMINI_IMAGE_MODEL = os.getenv("GEMINI_IMAGE_MODEL", "imagen-3.0-generate-002")
@@ -98,133 +107,280 @@ def validate_config() -> bool:
 
 
 def load_state() -> Dict[str, Any]:
-    default_state = {"current_story": "", "last_poll_message_id": None}
-    if STATE_FILE.exists():
-        try:
-            with open(STATE_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
-            return {
-                "current_story": data.get("current_story", ""),
-                "last_poll_message_id": data.get("last_poll_message_id"),
-            }
-        except Exception as e:
-            logging.error(f"Не удалось загрузить состояние: {e}. Начинаем заново.")
-            return default_state
-    return default_state
+    default_state = {"chunks": [], "last_poll_message_id": None}
+    try:
+        # одно чтение байтов без exists() и текстовой обёртки
+        data = orjson.loads(STATE_FILE.read_bytes())
+        if not isinstance(data, dict):
+            raise ValueError("ожидался JSON-объект")
+    except FileNotFoundError:
+        return default_state
+    except Exception as e:
+        logging.error(f"Не удалось загрузить состояние: {e}. Начинаем заново.")
+        return default_state
+    chunks = data.get("chunks")
+    if chunks is None:
+        # старый формат: вся история одной строкой в current_story
+        legacy = data.get("current_story", "")
+        chunks = [legacy] if legacy else []
+    return {
+        "chunks": chunks,
+        "last_poll_message_id": data.get("last_poll_message_id"),
+    }
 
 
 def save_state(state: Dict[str, Any]) -> None:
     try:
         tmp = STATE_FILE.with_suffix(".json.tmp")
-        with open(tmp, "w", encoding="utf-8") as f:
-            json.dump(state, f, ensure_ascii=False, indent=2)
+        data = orjson.dumps(state)  # компактный UTF-8 без отступов
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
         os.replace(tmp, STATE_FILE)
         logging.info(f"Состояние сохранено: {state}")
     except Exception as e:
         logging.error(f"Не удалось сохранить состояние: {e}")
 
 
+async def save_state_async(state: Dict[str, Any]) -> None:
+    """save_state в отдельном потоке: запись и fsync не блокируют цикл событий."""
+    await asyncio.to_thread(save_state, state)
+
+
+def _story_context(chunks: List[str]) -> str:
+    """Склеиваем только последние куски истории, которые влезают в MAX_CONTEXT_CHARS."""
+    start = len(chunks)
+    size = 0
+    while start > 0 and size < MAX_CONTEXT_CHARS:
+        start -= 1
+        size += len(chunks[start]) + 2
+    return "\n\n".join(chunks[start:])[-MAX_CONTEXT_CHARS:]
+
+
+T = TypeVar("T")
+
+# httpx-ошибки транспорта не наследуются от встроенных TimeoutError/ConnectionError
+_TRANSIENT_ERRORS = (errors.ServerError, httpx.TransportError, TimeoutError, ConnectionError)
+
+
+def _is_transient_error(e: Exception) -> bool:
+    """5xx, сетевые сбои и таймауты, а также 429 (превышен лимит запросов)."""
+    if isinstance(e, _TRANSIENT_ERRORS):
+        return True
+    return isinstance(e, errors.ClientError) and e.code == 429
+
+
+async def _with_retry(
+    coro_factory: Callable[[], Awaitable[T]],
+    attempts: int = GEMINI_RETRY_ATTEMPTS,
+    base: float = GEMINI_RETRY_BASE_DELAY,
+) -> T:
+    """Повторяем вызов при временной ошибке: пауза растёт экспоненциально (с потолком)
+    плюс небольшой джиттер. После последней попытки ошибка пробрасывается наверх."""
+    for i in range(attempts):
+        try:
+            return await coro_factory()
+        except Exception as e:
+            if i == attempts - 1 or not _is_transient_error(e):
+                raise
+            delay = min(base * 2 ** i, GEMINI_RETRY_MAX_DELAY) + random.random() * 0.1
+            logging.warning(f"Временная ошибка Gemini: {e}. Повтор через {delay:.1f} сек.")
+            await asyncio.sleep(delay)
+    raise RuntimeError("attempts должно быть >= 1")
+
+
+_DECODER = json.JSONDecoder()
+_json_loads = json.loads
+
+
 def _extract_json(text: str) -> Optional[Dict[str, Any]]:
-    """Пытаемся аккуратно достать JSON-объект из произвольного текста."""
+    """Пытаемся аккуратно достать JSON-объект из произвольного текста.
+    Быстрый путь: текст целиком в фигурных скобках — один json.loads.
+    Иначе пробуем декодировать объект с каждого '{' по порядку; хвост после него игнорируется."""
     text = (text or "").strip()
     if not text:
         return None
-    # Прямой парсинг
-    try:
-        return json.loads(text)
-    except Exception:
-        pass
-    # Эвристика: берём подстроку от первого '{' до последней '}'
-    try:
-        start = text.find("{")
-        end = text.rfind("}")
-        if start != -1 and end != -1 and end > start:
-            maybe = text[start : end + 1]
-            return json.loads(maybe)
-    except Exception:
-        pass
+    # Быстрый путь: ответ по схеме — это ровно один объект
+    if text[0] == "{" and text[-1] == "}":
+        try:
+            obj = _json_loads(text)
+            if isinstance(obj, dict):
+                return obj
+        except json.JSONDecodeError:
+            pass
+    i = text.find("{")
+    while i != -1:
+        try:
+            obj, _ = _DECODER.raw_decode(text, i)
+            if isinstance(obj, dict):
+                return obj
+        except json.JSONDecodeError:
+            pass
+        i = text.find("{", i + 1)
     return None
 
 
+_STORY_PART_RE = re.compile(r'"story_part"\s*:\s*"')
+
+
+def _partial_story_part(text: str) -> str:
+    """Достаём значение story_part из JSON, который ещё может быть не дописан.
+    Нужен, чтобы оборвать поток, как только текста набралось на пост."""
+    m = _STORY_PART_RE.search(text)
+    if not m:
+        return ""
+    start = i = m.end()
+    n = len(text)
+    while i < n and text[i] != '"':
+        i += 2 if text[i] == "\\" else 1
+    raw = text[start:min(i, n)]
+    # обрезанный хвост может попасть посреди escape-последовательности (\uXXXX — до 6 символов)
+    for cut in range(7):
+        try:
+            return _json_loads('"' + raw[: len(raw) - cut] + '"')
+        except json.JSONDecodeError:
+            continue
+    return ""
+
+
+# ------------------ LLM: инструкции, схемы, конфиги ------------------
+# Всё, что не зависит от шага, собираем один раз при импорте.
+_SYS_STORY = (
+    "Ты — креативный писатель на русском. Продолжай интерактивную историю ТРЕМЯ абзацами,\n"
+    "учитывая победивший вариант опроса. Каждый абзац отделяй пустой строкой.\n"
+    f"Абзацы короткие (1-2 предложения). Общая длина не более {MAX_POST_CHARS} символов.\n"
+    "Избегай клише и 'AI slop'. Не меняй стиль рассказчика без причины.\n\n"
+    "Формат ответа: ВОЗВРАЩАЙ только JSON-объект без пояснений,\n"
+    "с полями: {\"reasoning\": string, \"story_part\": string}. Без Markdown и кодовых блоков."
+)
+
+_SYS_POLL = (
+    "Ты помогаешь интерактивной истории. На основе ПОЛНОГО текущего текста предложи ровно 4\n"
+    "КОРОТКИХ и радикально разных варианта продолжения (<= 90 символов).\n"
+    "Верни ТОЛЬКО JSON: {\"options\": string[4]}."
+)
+
+# Модель отвечает строго JSON по схеме, так что ответ обычно парсится с первого символа.
+_STORY_SCHEMA = types.Schema(
+    type=types.Type.OBJECT,
+    properties={
+        "reasoning": types.Schema(type=types.Type.STRING),
+        "story_part": types.Schema(type=types.Type.STRING),
+    },
+    required=["story_part"],
+)
+
+_POLL_SCHEMA = types.Schema(
+    type=types.Type.OBJECT,
+    properties={
+        "options": types.Schema(
+            type=types.Type.ARRAY,
+            items=types.Schema(type=types.Type.STRING),
+            min_items=4,
+            max_items=4,
+        ),
+    },
+    required=["options"],
+)
+
+_CFG_STORY = types.GenerateContentConfig(
+    system_instruction=_SYS_STORY,
+    temperature=0.7,
+    max_output_tokens=700,
+    thinking_config=types.ThinkingConfig(thinking_budget=0),
+    response_mime_type="application/json",
+    response_schema=_STORY_SCHEMA,
+)
+
+_CFG_POLL = types.GenerateContentConfig(
+    system_instruction=_SYS_POLL,
+    temperature=0.6,
+    max_output_tokens=200,
+    thinking_config=types.ThinkingConfig(thinking_budget=0),
+    response_mime_type="application/json",
+    response_schema=_POLL_SCHEMA,
+)
+
+
 # ------------------ LLM: история ------------------
-def generate_story_continuation(current_story: str, user_choice: str) -> Optional[str]:
+async def generate_story_continuation(truncated_ctx: str, user_choice: str) -> Optional[str]:
     """Просим модель выдать три коротких абзаца продолжения.
     Каждый абзац — 1-2 предложения, общий текст не длиннее MAX_POST_CHARS.
-    Возвращается JSON с полями reasoning и story_part."""
-    truncated = current_story[-MAX_CONTEXT_CHARS:]
-
-    system_instruction = (
-        "Ты — креативный писатель на русском. Продолжай интерактивную историю ТРЕМЯ абзацами,\n"
-        "учитывая победивший вариант опроса. Каждый абзац отделяй пустой строкой.\n"
-        f"Абзацы короткие (1-2 предложения). Общая длина не более {MAX_POST_CHARS} символов.\n"
-        "Избегай клише и 'AI slop'. Не меняй стиль рассказчика без причины.\n\n"
-        "Формат ответа: ВОЗВРАЩАЙ только JSON-объект без пояснений,\n"
-        "с полями: {\"reasoning\": string, \"story_part\": string}. Без Markdown и кодовых блоков."
-    )
+    Возвращается JSON с полями reasoning и story_part.
+    truncated_ctx — уже обрезанный до MAX_CONTEXT_CHARS хвост истории (см. _story_context)."""
 
     user_prompt = (
-        f"Предыдущая история:\n{truncated}\n\n"
+        f"Предыдущая история:\n{truncated_ctx}\n\n"
         f"Выбор пользователя: '{user_choice}'\n\n"
         f"Верни только JSON c полями reasoning и story_part. story_part <= {MAX_POST_CHARS} символов."
     )
 
-    try:
-        resp = client.models.generate_content(
+    async def read_stream() -> str:
+        # Запрос уходит только на первом __anext__, поэтому под ретраем — всё чтение потока.
+        # Всё, что длиннее MAX_POST_CHARS, всё равно обрежем — не ждём, пока модель допишет.
+        buf: List[str] = []
+        size = 0
+        stream = await client.aio.models.generate_content_stream(
             model=GEMINI_MODEL,
             contents=user_prompt,
-            config=types.GenerateContentConfig(
-                system_instruction=system_instruction,
-                temperature=0.7,
-                max_output_tokens=700,
-                thinking_config=types.ThinkingConfig(thinking_budget=0),
-            ),
+            config=_CFG_STORY,
         )
-        data = _extract_json(resp.text)
-        if not data:
+        async with aclosing(stream):
+            try:
+                async for chunk in stream:
+                    if chunk.text:
+                        buf.append(chunk.text)
+                        size += len(chunk.text)
+                    if size >= MAX_POST_CHARS and len(_partial_story_part("".join(buf))) >= MAX_POST_CHARS:
+                        logging.info("story_part уже не короче лимита — обрываем генерацию.")
+                        break
+            except Exception as e:
+                # Обрывок не публикуем: попытка считается неудачной, решает _with_retry.
+                # Исключение — текста уже на целый пост, как при намеренном break выше.
+                if len(_partial_story_part("".join(buf))) < MAX_POST_CHARS:
+                    raise
+                logging.warning(f"Поток Gemini оборвался после полного поста: {e}.")
+        return "".join(buf)
+
+    try:
+        text = await _with_retry(read_stream)
+        data = _extract_json(text)
+        part = (data.get("story_part") or "") if data else _partial_story_part(text)
+        part = part.strip()[:MAX_POST_CHARS]
+        if not part:
             logging.error("Модель вернула не-JSON или пустой текст")
             return None
-        part = (data.get("story_part") or "").strip()
-        part = part[:MAX_POST_CHARS]
-        return part or None
+        return part
     except Exception as e:
         logging.error(f"Ошибка Gemini при генерации истории: {e}")
         return None
 
 
 # ------------------ LLM: варианты опроса ------------------
-def generate_poll_options(full_story_context: str) -> Optional[List[str]]:
-    truncated = full_story_context[-MAX_CONTEXT_CHARS:]
-
-    system_instruction = (
-        "Ты помогаешь интерактивной истории. На основе ПОЛНОГО текущего текста предложи ровно 4\n"
-        "КОРОТКИХ и радикально разных варианта продолжения (<= 90 символов).\n"
-        "Верни ТОЛЬКО JSON: {\"options\": string[4]}."
-    )
-
-    user_prompt = f"Контекст истории:\n{truncated}\n\nВерни только JSON с массивом 'options' из 4 строк."
+async def generate_poll_options(truncated_ctx: str) -> Optional[List[str]]:
+    user_prompt = f"Контекст истории:\n{truncated_ctx}\n\nВерни только JSON с массивом 'options' из 4 строк."
 
     try:
-        resp = client.models.generate_content(
-            model=GEMINI_MODEL,
-            contents=user_prompt,
-            config=types.GenerateContentConfig(
-                system_instruction=system_instruction,
-                temperature=0.6,
-                max_output_tokens=200,
-                thinking_config=types.ThinkingConfig(thinking_budget=0),
-            ),
+        resp = await _with_retry(
+            lambda: client.aio.models.generate_content(
+                model=GEMINI_MODEL,
+                contents=user_prompt,
+                config=_CFG_POLL,
+            )
         )
         data = _extract_json(resp.text)
         if not data or "options" not in data:
             logging.error("Не удалось распарсить JSON с вариантами опроса")
             return None
         options_raw = data.get("options", [])
-        options: List[str] = []
-        for o in options_raw:
-            if isinstance(o, str):
-                s = o.strip()[:90]
-                if len(s) >= 5:
-                    options.append(s)
+        options: List[str] = [
+            s for o in options_raw if isinstance(o, str) for s in (o.strip()[:90],) if len(s) >= 5
+        ]
         if len(options) != 4:
             logging.error(f"Ожидалось 4 варианта, получили {len(options)}")
             return None
@@ -261,41 +417,36 @@ async def get_poll_winner(bot: Bot, chat_id: str | int, message_id: int) -> Opti
         updated_poll: Poll = await bot.stop_poll(chat_id=chat_id, message_id=message_id)
         logging.info("Опрос закрыт.")
 
-        winning_options: List[str] = []
-        max_votes = -1
-        for option in updated_poll.options:
-            if option.voter_count > max_votes:
-                max_votes = option.voter_count
-                winning_options = [option.text]
-            elif option.voter_count == max_votes and max_votes > 0:
-                winning_options.append(option.text)
-
-        if max_votes > 0 and len(winning_options) == 1:
-            return winning_options[0]
-        elif max_votes > 0:
-            logging.warning("Ничья в опросе — берём первый из лидеров.")
-            return winning_options[0]
-        else:
-            logging.info("В опросе нет голосов — выбираем случайно.")
-            if updated_poll.options:
-                return random.choice(updated_poll.options).text
+        if not updated_poll.options:
             return None
+        # max берёт первый из лидеров, так что ничья решается в пользу верхнего варианта
+        best = max(updated_poll.options, key=lambda o: o.voter_count)
+        if best.voter_count == 0:
+            logging.info("В опросе нет голосов — выбираем случайно.")
+            return random.choice(updated_poll.options).text
+        return best.text
     except telegram.error.TelegramError as e:
         logging.error(f"Ошибка при остановке опроса: {e}")
         return None
 
 
 # ------------------ Основной шаг истории ------------------
-async def run_story_step():
+async def run_story_step(bot: Bot) -> Optional[asyncio.Task]:
+    """Один шаг истории. Возвращает задачу сохранения состояния (или None, если шаг сорвался),
+    чтобы запись на диск шла параллельно с паузой до следующего шага."""
     logging.info("--- Шаг истории ---")
     state = load_state()
-    current_story: str = state.get("current_story", "")
+    chunks: List[str] = state.get("chunks", [])
+    # контекст для модели собираем один раз на шаг
+    ctx = _story_context(chunks)
     last_poll_message_id = state.get("last_poll_message_id")
 
-    bot = Bot(token=BOT_TOKEN)
-
     next_prompt: Optional[str] = None
     new_poll_message_id: Optional[int] = None
+    # варианты опроса зависят только от итогового текста, поэтому генерим их
+    # параллельно с отправкой поста в канал
+    options_task: Optional[asyncio.Task] = None
+    save_task: Optional[asyncio.Task] = None
 
     try:
         # 1) Кто победил в прошлом опросе?
@@ -312,22 +463,30 @@ async def run_story_step():
             next_prompt = INITIAL_STORY_IDEA
 
         # 2) Публикуем первую часть или генерим продолжение
-        if not current_story:
+        if not chunks:
             logging.info(f"Публикуем старт истории в канал {CHANNEL_ID}…")
+            options_task = asyncio.create_task(
+                generate_poll_options(_story_context([INITIAL_STORY_IDEA]))
+            )
             await bot.send_message(chat_id=CHANNEL_ID, text=INITIAL_STORY_IDEA)
-            current_story = INITIAL_STORY_IDEA
+            chunks = [INITIAL_STORY_IDEA]
         else:
             if not next_prompt:
                 next_prompt = "Продолжай логично и интересно."
             logging.info(f"Генерируем продолжение по выбору: '{next_prompt}'…")
-            new_part = generate_story_continuation(current_story, next_prompt)
+            new_part = await generate_story_continuation(ctx, next_prompt)
             if not new_part or not new_part.strip():
                 raise RuntimeError("Не удалось сгенерировать продолжение истории.")
+            # ctx — уже готовый хвост истории, достаточно дописать к нему новый кусок
+            options_task = asyncio.create_task(
+                generate_poll_options((ctx + "\n\n" + new_part)[-MAX_CONTEXT_CHARS:])
+            )
             send_text_first = True  # можно поменять порядок, как нравится
 
             if ENABLE_IMAGE_GEN:
-                # используем свежесгенерованный кусок как описание сцены
-                img_bytes = generate_image_bytes_from_text(new_part)
+                # используем свежесгенерованный кусок как описание сцены;
+                # синхронный вызов уводим в поток, чтобы генерация опроса шла параллельно
+                img_bytes = await asyncio.to_thread(generate_image_bytes_from_text, new_part)
             else:
                 img_bytes = None
 
@@ -342,10 +501,13 @@ async def run_story_step():
                     # если хотели сначала картинку, а её нет — отправим текст
                     await bot.send_message(chat_id=CHANNEL_ID, text=new_part)
 
-                current_story += ("\n\n" if not current_story.endswith("\n\n") else "") + new_part
+                chunks.append(new_part)
 
             except telegram.error.TelegramError as e:
                 logging.error(f"Не удалось отправить пост/картинку: {e}")
+                # история не продвинулась — варианты для нового текста не годятся
+                options_task.cancel()
+                options_task = None
                 # на всякий случай отправим текст, если ничего не ушло
                 try:
                     if not send_text_first and not img_bytes:
@@ -355,7 +517,10 @@ async def run_story_step():
 
         # 3) Генерируем и публикуем опрос
         logging.info("Генерируем варианты опроса…")
-        poll_options = generate_poll_options(current_story) or [
+        if options_task is None:
+            # сюда попадаем только если пост не ушёл — история не изменилась, ctx актуален
+            options_task = asyncio.create_task(generate_poll_options(ctx))
+        poll_options = await options_task or [
             "Продолжить штурмовать позиции",
             "Искать обходной путь",
             "Запросить подкрепление",
@@ -372,18 +537,19 @@ async def run_story_step():
         sent: Message = await bot.send_poll(
             chat_id=CHANNEL_ID,
             question=POLL_QUESTION_TEMPLATE,
-            options=[o[:90] for o in poll_options],
+            options=poll_options,  # уже обрезаны до 90 символов в generate_poll_options
             is_anonymous=True,
         )
         new_poll_message_id = sent.message_id
         logging.info(f"Опрос опубликован (id={new_poll_message_id}).")
 
-        # 4) Сохраняем состояние
-        save_state({
-            "current_story": current_story,
+        # 4) Сохраняем состояние (дожидается run_forever вместе с паузой)
+        save_task = asyncio.create_task(save_state_async({
+            "chunks": chunks,
             "last_poll_message_id": new_poll_message_id,
-        })
-        logging.info("--- Шаг истории успешно завершён ---")
+        }))
+        # сам факт записи логирует save_state, когда поток её закончит
+        logging.info("--- Шаг истории опубликован, состояние сохраняется в фоне ---")
 
     except RuntimeError as e:
         logging.error(f"Runtime ошибка: {e}")
@@ -391,16 +557,36 @@ async def run_story_step():
         logging.error(f"Telegram ошибка: {e}")
     except Exception as e:
         logging.error(f"Непредвиденная ошибка: {e}", exc_info=True)
+    finally:
+        if options_task is not None and not options_task.done():
+            options_task.cancel()
+    return save_task
 
 
 async def run_forever():
-    """Бесконечный цикл шагов истории."""
+    """Бесконечный цикл шагов истории.
+    Один Bot на весь процесс: HTTP-соединения к Telegram переиспользуются между шагами.
+    Если бота не удалось инициализировать (get_me), пробуем снова через STEP_INTERVAL_SECONDS."""
+    bot = Bot(token=BOT_TOKEN)
     while True:
-        await run_story_step()
-        logging.info(
-            f"Ждём {STEP_INTERVAL_SECONDS} сек. до следующего шага истории…"
-        )
-        await asyncio.sleep(STEP_INTERVAL_SECONDS)
+        try:
+            async with bot:
+                while True:
+                    save_task = await run_story_step(bot)
+                    logging.info(
+                        f"Ждём {STEP_INTERVAL_SECONDS} сек. до следующего шага истории…"
+                    )
+                    # следующий шаг читает состояние с диска, поэтому сохранение должно завершиться до него
+                    if save_task is not None:
+                        await asyncio.gather(save_task, asyncio.sleep(STEP_INTERVAL_SECONDS))
+                    else:
+                        await asyncio.sleep(STEP_INTERVAL_SECONDS)
+        except telegram.error.TelegramError as e:
+            logging.error(
+                f"Не удалось инициализировать Telegram-бота: {e}. "
+                f"Повтор через {STEP_INTERVAL_SECONDS} сек."
+            )
+            await asyncio.sleep(STEP_INTERVAL_SECONDS)
 
 
 # ------------------ Запуск ------------------